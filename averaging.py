@@ -0,0 +1,32 @@
+# Numba-kernel to sum the readings received between two plot-points
+# Kept in a separate module (instead of witrn-ui-bokeh.py) so Numba can cache the compiled function
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError: # Numba isn't available on PyPy, witrn-ui-bokeh.py keeps plain running sums instead (NumPy-indexing is slow there)
+    HAVE_NUMBA = False
+
+
+if HAVE_NUMBA:
+    # Explicit signature to compile when the module gets imported, instead of on the first plot-point
+    @njit('f8[:](f8[:], f8[:], i8)', cache=True)
+    def sum_batch(voltage, current, n):
+        sum_v = 0.0
+        sum_i = 0.0
+        sum_p = 0.0
+        for k in range(n):
+            sum_v += voltage[k]
+            sum_i += current[k]
+            sum_p += voltage[k] * current[k]
+
+        result = np.empty(3, dtype=np.float64)
+        result[0] = sum_v
+        result[1] = sum_i
+        result[2] = sum_p
+        return result # Sum of the first n voltage, current and power readings
+
+    # Call once to make sure the (cached) function is loaded before the first reading arrives
+    sum_batch(np.zeros(1, dtype=np.float64), np.zeros(1, dtype=np.float64), 1)
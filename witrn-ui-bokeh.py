@@ -8,26 +8,29 @@
 #  - https://docs.bokeh.org/en/latest/docs/user_guide/server/app.html#updating-from-threads
 
 
-# TODO Take an average of readings between log/plot periods instead of "throwing the values away"?
-# TODO Don't plot/log power (and current) to increase performance? -> Defines?
+# TODO Take an average of readings between log periods instead of "throwing the values away"?
+# TODO Don't log power (and plot/log current) to increase performance? -> Defines?
 
 # TODO Add functionality to read csv-files and plot them again
 # TODO Add RadioButtonGroup to select the "real-time" or "after the fact" plotting-mode
 
 
 
-from bokeh.models import ColumnDataSource, LinearAxis, DataRange1d, DatetimeTickFormatter, Legend, PrintfTickFormatter, Button, TextInput, Div, Select, Label, NumericInput, Switch
+from bokeh.models import ColumnDataSource, LinearAxis, DataRange1d, DatetimeTickFormatter, Legend, PrintfTickFormatter, Button, TextInput, Div, Select, Label, NumericInput, Switch, HoverTool
 from bokeh.io import curdoc
 from bokeh.plotting import figure
 from bokeh.palettes import Category20c_20 as COLOR # See https://docs.bokeh.org/en/latest/docs/reference/palettes.html
 from bokeh.layouts import column, row
 
 from datetime import datetime, timedelta
-from threading import Thread
-from functools import partial
-import csv
+from threading import Thread, Lock, Event
 import time
+import os
+import numpy as np
 
+from averaging import HAVE_NUMBA
+if HAVE_NUMBA:
+    from averaging import sum_batch
 from driver import USBMeter
 from driver.protocol import KnownDevice, HIDPacket, Command
 from enum import Enum
@@ -49,29 +52,76 @@ POW_END    = 100
 # Maximum amount of X-axis data-points before discarting old data
 MAX_X_POINTS = 6000
 
+# Data-type of the plotted values
+PLOT_DTYPE = np.float32
+
+# Amount of readings buffered before they get added to the running sums by the Numba-kernel
+AVG_BUFFER_SIZE = 1024
+
+# Period at which the buffered measurements get streamed to the plot (and written to the csv-file) in one go
+FLUSH_PERIOD_MS = 50
+
 
 # Save curdoc() to make sure all threads see the same document
 doc = curdoc()
 
-# Create the data-source
-data_source = ColumnDataSource(data = {"DateTime": [],
-                                       "DateTimeStr": [],
-                                       "voltage": [],
-                                       "current": [],
-                                       "power": []})
-
-# Tooltip (hover) settings
+def empty_columns():
+    # NumPy-arrays get sent to the browser as binary buffers instead of JSON-lists
+    # (float32 is plenty for the resolution of the meter, halves the size of the buffers)
+    return {"DateTime": np.empty(0, dtype="datetime64[ms]"),
+            "voltage": np.empty(0, dtype=PLOT_DTYPE),
+            "current": np.empty(0, dtype=PLOT_DTYPE)}
+
+def empty_power_columns():
+    return {"DateTime": np.empty(0, dtype="datetime64[ms]"),
+            "power": np.empty(0, dtype=PLOT_DTYPE)}
+
+def empty_pending():
+    return {"DateTime": [],
+            "voltage": [],
+            "current": [],
+            "power": []}
+
+# Create the data-sources (power has its own, which only gets updated while the power-line is visible)
+data_source = ColumnDataSource(data = empty_columns())
+power_source = ColumnDataSource(data = empty_power_columns())
+
+# Measurements waiting to be streamed to the plot, rows waiting to be written to the csv-file and
+# the latest text for the measurement-label (filled by the meter-thread, emptied by flush_pending)
+pending_lock = Lock()
+pending = empty_pending()
+pending_rows = []
+pending_meas_text = None
+
+# Readings received since the last plot-point (filled by the meter-thread, averaged into the next plot-point,
+# the plotted power is the mean of voltage * current of the readings)
+# All of them get averaged: with Numba they're buffered and added to the running sums in batches, without
+# Numba they're added to the running sums directly
+avg_voltage = np.zeros(AVG_BUFFER_SIZE, dtype=np.float64)
+avg_current = np.zeros(AVG_BUFFER_SIZE, dtype=np.float64)
+avg_sum_voltage = 0.0
+avg_sum_current = 0.0
+avg_sum_power = 0.0
+avg_count = 0
+avg_reset = False # Set by the Bokeh-thread, avg_count only gets changed by the meter-thread
+
+# Tooltip (hover) settings (the power-line uses a different data-source, and thus a separate tooltip)
 TOOLTIPS = f"""
     <div>
         <font color="{COLOR[4]}">Voltage: @voltage V</font><br>
         <font color="{COLOR[0]}">Current: @current A</font><br>
+        Time: @DateTime{{%H:%M:%S.%3N}}<br>
+    </div>
+"""
+POWER_TOOLTIPS = f"""
+    <div>
         <font color="{COLOR[8]}">Power: @power W</font><br>
-        Time: @DateTimeStr<br>
+        Time: @DateTime{{%H:%M:%S.%3N}}<br>
     </div>
 """
 
-# Tool settings
-TOOLS = "pan,box_zoom,xwheel_zoom,ywheel_zoom,xwheel_pan,reset,undo,redo,save,hover"
+# Tool settings (the hover-tools get added after the plot-lines)
+TOOLS = "pan,box_zoom,xwheel_zoom,ywheel_zoom,xwheel_pan,reset,undo,redo,save"
 
 # Basic figure settings
 fig = figure(width=PLOT_WIDTH, height=PLOT_HEIGHT,
@@ -82,7 +132,7 @@ fig = figure(width=PLOT_WIDTH, height=PLOT_HEIGHT,
             #  sizing_mode="stretch_width", height=450,
             #  toolbar_location="above",
             #  output_backend="webgl",
-             tooltips=TOOLTIPS, tools=TOOLS)
+             tools=TOOLS)
 
 # X-axis settings
 fig.xaxis.axis_label = "Time"
@@ -124,27 +174,35 @@ new_title = Label(x=0, y=-50, x_units='screen', y_units='screen', text=plot_titl
 fig.add_layout(new_title, "above")
 
 # Add the plot-lines
-fig.line(x="DateTime", y="voltage", line_color=COLOR[4], line_width=2, source=data_source, legend_label="Voltage")
-fig.line(x="DateTime", y="current", line_color=COLOR[0], line_width=2, source=data_source, legend_label="Current", y_range_name="A")
-fig.line(x="DateTime", y="power",   line_color=COLOR[8], line_width=2, source=data_source, legend_label="Power",   y_range_name="W", visible=False)
+voltage_line = fig.line(x="DateTime", y="voltage", line_color=COLOR[4], line_width=2, source=data_source,  legend_label="Voltage")
+current_line = fig.line(x="DateTime", y="current", line_color=COLOR[0], line_width=2, source=data_source,  legend_label="Current", y_range_name="A")
+power_line   = fig.line(x="DateTime", y="power",   line_color=COLOR[8], line_width=2, source=power_source, legend_label="Power",   y_range_name="W", visible=False)
+
+# Add the hover-tools (the time gets formatted in the browser)
+fig.add_tools(HoverTool(renderers=[voltage_line, current_line], tooltips=TOOLTIPS, formatters={"@DateTime": "datetime"}),
+              HoverTool(renderers=[power_line], tooltips=POWER_TOOLTIPS, formatters={"@DateTime": "datetime"}))
 
 # CSV logging variables/defaults
 logging = False
 log_period_ms = 250
+log_period_ns = log_period_ms * 1_000_000 # Used by on_packet, updated together with log_period_ms
 csv_file = ""
+csv_fh = None
 
 # Meter variables/defaults
 plot_period_ms = 0
+plot_period_ns = plot_period_ms * 1_000_000 # Used by on_packet, updated together with plot_period_ms
 meter = None
-last_meas_time = None
-last_plot_time = None
-last_log_time  = None
+last_meas_ns = None # time.monotonic_ns() timestamps of the last measurement/plot/log update
+last_plot_ns = None
+last_log_ns  = None
 invert_current = True
-selected_device = "C4"
+current_sign = -1.0 if invert_current else 1.0 # Applied to every reading, updated together with invert_current
+selected_device = KnownDevice.C4
 
 # Create a dropdown for the device-selection, buttons to open and close the connection, a status-label
 # as well as a switch to change the current-sign-logic
-device_select = Select(title="Device", value=selected_device, options=KnownDevice._member_names_)
+device_select = Select(title="Device", value=selected_device.name, options=KnownDevice._member_names_)
 open_conn_button  = Button(label="Open Connection",  button_type="success", align="center")
 close_conn_button = Button(label="Close Connection", button_type="danger",  align="center", disabled=True)
 status_label = Div(text="", width=305, align="center")
@@ -169,6 +227,27 @@ meas_text = """
         """
 measurement_label = Div(text=meas_text, width=PLOT_WIDTH)
 
+# Template for the measurement-values (only the values still need to be formatted in on_packet)
+MEAS_INDENT = "&emsp;" * 18
+MEAS_TEMPLATE = f"""
+            <div>
+                {MEAS_INDENT}
+                <b>Last Measurements:&emsp;</b>
+                <font color="{COLOR[4]}">Voltage: {{voltage:.3f}} V</font> //
+                <font color="{COLOR[0]}">Current: {{current:.3f}} A</font> // 
+                <font color="{COLOR[8]}">Power: {{power:.3f}} W</font> //
+                Time: {{time}}<br>
+                {MEAS_INDENT}
+                <b>Accumulated Data: &emsp;&ensp;</b>
+                Capacity: {{ah:.3f}} Ah // Energy: {{wh:.3f}} Wh // 
+                Threshold: {{recmA}} mA // Recording: {{recTime}} //
+                Group: {{recGrp}} // Uptime: {{runTime}}
+                {MEAS_INDENT}
+                <b>Offline Recording: &emsp;&emsp; </b>Recording: {{offHour}} h // Remaining (?): {{offPer}} measurements // Reserved (?): {{reserved}}
+            </div>
+        """
+MEAS_TEMPLATE = " ".join(MEAS_TEMPLATE.split()) # The browser collapses the whitespace anyway, don't send it every update
+
 # State-machine variable
 class state(Enum):
     STOPPED = 0
@@ -176,105 +255,188 @@ class state(Enum):
     RUNNING = 2
     STOPPING = 3
 main_state = state.STOPPED
+state_event = Event() # Set when main_method needs to handle a state-change
+
+
+def set_state(new_state: state):
+    global main_state
+
+    main_state = new_state
+    state_event.set()
+
+
+def format_hms_ms(dt: datetime):
+    # Same result as dt.strftime('%H:%M:%S.%f')[:-3], without going through strftime
+    return f"{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}.{dt.microsecond // 1000:03d}" # TODO Do actual µs to ms rounding instead of truncating (?)
+
+
+def add_buffered_readings(n: int):
+    global avg_sum_voltage, avg_sum_current, avg_sum_power
+
+    # Add the first n buffered readings to the running sums (only used with Numba, called from the meter-thread)
+    sums = sum_batch(avg_voltage, avg_current, n)
+    avg_sum_voltage += sums[0]
+    avg_sum_current += sums[1]
+    avg_sum_power += sums[2]
 
 
 def on_packet(packet: HIDPacket):
-    global main_state, last_meas_time, last_plot_time, last_log_time
+    global main_state, last_meas_ns, last_plot_ns, last_log_ns, pending_meas_text
+    global avg_count, avg_reset, avg_sum_voltage, avg_sum_current, avg_sum_power
 
     if main_state != state.RUNNING:
         return
     if packet.payload.command != Command.DAT_RECV:
         return
 
-    datetime_now = datetime.now()
-    datetime_string = datetime_now.strftime('%H:%M:%S.%f')[:-3] # TODO Do actual µs to ms rounding instead of [:-3] (?)
+    now_ns = time.monotonic_ns()
 
-    if last_meas_time == None:
-        last_meas_time = datetime_now
-    if last_log_time == None:
-        last_log_time = datetime_now
-    if last_plot_time == None:
-        last_plot_time = datetime_now
+    if last_meas_ns == None:
+        last_meas_ns = now_ns
+    if last_log_ns == None:
+        last_log_ns = now_ns
+    if last_plot_ns == None:
+        last_plot_ns = now_ns
 
     data = packet.payload.data
 
     # TODO Use data.dp, data.dn, data.tempIn, data.tempOut?
 
-    if invert_current:
-        current = -data.current
+    # Read the attributes once, they get reused below
+    voltage = data.voltage
+    current = current_sign * data.current
+
+    # Keep every reading, these get averaged into the next plot-point
+    if avg_reset:
+        avg_reset = False
+        avg_count = 0
+        avg_sum_voltage = avg_sum_current = avg_sum_power = 0.0
+    if HAVE_NUMBA:
+        avg_voltage[avg_count % AVG_BUFFER_SIZE] = voltage
+        avg_current[avg_count % AVG_BUFFER_SIZE] = current
+        avg_count += 1
+        if avg_count % AVG_BUFFER_SIZE == 0:
+            add_buffered_readings(AVG_BUFFER_SIZE) # Buffer is full
     else:
-        current = data.current
-
-    power = data.voltage * current
-
-    if logging and (datetime_now - last_log_time) > timedelta(milliseconds=log_period_ms):
-        with open(csv_file, 'a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([datetime_now,
-                            data.voltage,
-                            current,
-                            power,
-                            data.ah, data.wh, data.recmA, data.recTime, data.recGrp+1, data.runTime])
-        last_log_time = datetime_now
-
-    if (datetime_now - last_plot_time) > timedelta(milliseconds=plot_period_ms):
-        # Update the document from a callback
-        doc.add_next_tick_callback(partial(update,
-                                        datetime=datetime_now,
-                                        datetimestr=datetime_string, 
-                                        voltage=data.voltage,
-                                        current=current,
-                                        power=power))
-        last_plot_time = datetime_now
-
-    if (datetime_now - last_meas_time) > timedelta(milliseconds=log_period_ms):
-        meas_text = f"""
-            <div>
-                &emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;
-                <b>Last Measurements:&emsp;</b>
-                <font color="{COLOR[4]}">Voltage: {f'{data.voltage:.3f}'} V</font> //
-                <font color="{COLOR[0]}">Current: {f'{current:.3f}'} A</font> // 
-                <font color="{COLOR[8]}">Power: {f'{power:.3f}'} W</font> //
-                Time: {datetime_string}<br>
-                &emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;
-                <b>Accumulated Data: &emsp;&ensp;</b>
-                Capacity: {f'{data.ah:.3f}'} Ah // Energy: {f'{data.wh:.3f}'} Wh // 
-                Threshold: {data.recmA} mA // Recording: {f'{str(timedelta(seconds=data.recTime))}'} //
-                Group: {data.recGrp+1} // Uptime: {f'{str(timedelta(seconds=data.runTime))}'}
-                &emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;&emsp;
-                <b>Offline Recording: &emsp;&emsp; </b>Recording: {data.offHour} h // Remaining (?): {data.offPer} measurements // Reserved (?): {data.reserved}
-            </div>
-        """
-        doc.add_next_tick_callback(lambda: measurement_label.update(text=meas_text)) # "lambda:" for in-line callbacks
-        last_meas_time = datetime_now
+        avg_sum_voltage += voltage
+        avg_sum_current += current
+        avg_sum_power += voltage * current
+        avg_count += 1
+
+    # Only integer compares for packets which don't need to be logged, plotted or shown
+    log_due  = logging and (now_ns - last_log_ns) > log_period_ns
+    plot_due = (now_ns - last_plot_ns) > plot_period_ns
+    meas_due = (now_ns - last_meas_ns) > log_period_ns
+    if not (log_due or plot_due or meas_due):
+        return
 
+    datetime_now = datetime.now() # Same timestamp for the row, plot-point and label of this packet
+
+    if log_due or meas_due:
+        # Shared by the csv-row and the measurement-label
+        power = voltage * current
+        ah, wh, recmA, recTime, recGrp, runTime = data.ah, data.wh, data.recmA, data.recTime, data.recGrp+1, data.runTime
+
+    if log_due:
+        # Buffer the (pre-formatted) row, flush_pending writes it to the (already opened) file periodically
+        row = f"{datetime_now},{voltage},{current},{power},{ah},{wh},{recmA},{recTime},{recGrp},{runTime}\r\n"
+        with pending_lock:
+            pending_rows.append(row)
+        last_log_ns = now_ns
+
+    if plot_due:
+        if avg_count == 1:
+            voltage_avg, current_avg, power_avg = voltage, current, voltage * current # Nothing to average (e.g. plot period of 0 ms)
+        else:
+            if HAVE_NUMBA and avg_count % AVG_BUFFER_SIZE:
+                add_buffered_readings(avg_count % AVG_BUFFER_SIZE)
+            voltage_avg, current_avg, power_avg = avg_sum_voltage / avg_count, avg_sum_current / avg_count, avg_sum_power / avg_count
+        avg_count = 0
+        avg_sum_voltage = avg_sum_current = avg_sum_power = 0.0
+
+        # Buffer the values, flush_pending streams them to the document periodically
+        with pending_lock:
+            pending["DateTime"].append(datetime_now)
+            pending["voltage"].append(voltage_avg)
+            pending["current"].append(current_avg)
+            pending["power"].append(power_avg)
+        last_plot_ns = now_ns
+
+    if meas_due:
+        meas_text = MEAS_TEMPLATE.format(voltage=voltage, current=current, power=power, time=format_hms_ms(datetime_now),
+                                         ah=ah, wh=wh, recmA=recmA, recTime=timedelta(seconds=recTime),
+                                         recGrp=recGrp, runTime=timedelta(seconds=runTime),
+                                         offHour=data.offHour, offPer=data.offPer, reserved=data.reserved)
+        # Only the latest text is kept, flush_pending updates the label periodically
+        with pending_lock:
+            pending_meas_text = meas_text
+        last_meas_ns = now_ns
 
-def on_error(error: Exception):
-    global main_state
 
+def on_error(error: Exception):
     print(f"Error: {error}")
-    doc.add_next_tick_callback(lambda: status_label.update(text=str(error))) # "lambda:" for in-line callbacks
-    main_state = state.STOPPED
+    doc.add_next_tick_callback(lambda: set_status_text(str(error))) # "lambda:" for in-line callbacks
+    if logging:
+        doc.add_next_tick_callback(on_stop_log_button) # Writes the remaining rows and closes the csv-file
+    set_state(state.STOPPED)
+
+
+def flush_pending():
+    global pending, pending_rows, pending_meas_text
+
+    # Swap the buffers so the meter-thread can keep appending while writing/streaming
+    # (always swap, the meter-thread must never append to the lists that get written/streamed below)
+    with pending_lock:
+        batch, pending = pending, empty_pending()
+        rows, pending_rows = pending_rows, []
+        meas_text, pending_meas_text = pending_meas_text, None
+
+    if rows and csv_fh is not None:
+        csv_fh.write("".join(rows)) # Single write-call for all of the buffered rows
+        csv_fh.flush() # Hand the rows to the OS, so they don't get lost if the server gets stopped
+
+    if batch["DateTime"]:
+        data_source.stream({"DateTime": np.asarray(batch["DateTime"], dtype="datetime64[ms]"),
+                            "voltage": np.asarray(batch["voltage"], dtype=PLOT_DTYPE),
+                            "current": np.asarray(batch["current"], dtype=PLOT_DTYPE)}, rollover=MAX_X_POINTS)
+        if power_line.visible: # Don't send the power to the browser while it isn't shown
+            power_source.stream({"DateTime": np.asarray(batch["DateTime"], dtype="datetime64[ms]"),
+                                 "power": np.asarray(batch["power"], dtype=PLOT_DTYPE)}, rollover=MAX_X_POINTS)
+
+    if meas_text is not None:
+        measurement_label.text = meas_text
 
 
-async def update(datetime, datetimestr, voltage, current, power):
-    data_source.stream({"DateTime": [datetime],
-                        "DateTimeStr": [datetimestr],
-                        "voltage": [voltage],
-                        "current": [current],
-                        "power": [power]}, rollover=MAX_X_POINTS)
+# Next-tick callbacks for the widget-changes from the other threads (grouped, properties are assigned directly)
+def set_status_text(text: str):
+    status_label.text = text
+
+
+def on_conn_opened():
+    status_label.text = "" # Doesn't get sent to the browser if it was already empty
+    close_conn_button.disabled = False
+
+
+def enable_conn_inputs(status_text: str = None):
+    if status_text is not None:
+        status_label.text = status_text
+    device_select.disabled = False
+    open_conn_button.disabled = False
+    invert_sign_switch.disabled = False
+    # plot_period_input.disabled = False # Can be updated on-the-fly
 
 
 def main_method():
     global meter, main_state
 
     while True:
-        if main_state == state.STOPPED:
-            time.sleep(0.1)
+        # Block until a state-change happens (STOPPED and RUNNING don't require any work here)
+        state_event.wait()
+        state_event.clear()
 
-        elif main_state == state.INITIALIZING:
+        if main_state == state.INITIALIZING:
             try:
-                meter = USBMeter(KnownDevice[selected_device])
+                meter = USBMeter(selected_device)
                 meter.recv_callback(on_packet)
                 meter.error_callback(on_error)
                 meter.connect()
@@ -282,35 +444,23 @@ def main_method():
                 error_string = type(e).__name__ + ": " + str(e)
                 print(f"Failed to connect: {error_string}")
 
-                doc.add_next_tick_callback(lambda: status_label.update(text=error_string)) # "lambda:" for in-line callbacks
-                doc.add_next_tick_callback(lambda: device_select.update(disabled=False))
-                doc.add_next_tick_callback(lambda: open_conn_button.update(disabled=False))
-                doc.add_next_tick_callback(lambda: invert_sign_switch.update(disabled=False))
-                # doc.add_next_tick_callback(lambda: plot_period_input.update(disabled=False)) # Can be updated on-the-fly
+                doc.add_next_tick_callback(lambda: enable_conn_inputs(error_string)) # "lambda:" for in-line callbacks
 
                 main_state = state.STOPPED
                 continue
 
-            if status_label.text != "":
-                doc.add_next_tick_callback(lambda: status_label.update(text="")) # "lambda:" for in-line callbacks
-            doc.add_next_tick_callback(lambda: close_conn_button.update(disabled=False))
+            doc.add_next_tick_callback(on_conn_opened)
 
             meter.start_read()
 
             main_state = state.RUNNING
 
-        elif main_state == state.RUNNING:
-            time.sleep(0.001)
-
         elif main_state == state.STOPPING:
             meter.stop_read()
             time.sleep(0.1)
             meter.disconnect()
 
-            doc.add_next_tick_callback(lambda: device_select.update(disabled=False)) # "lambda:" for in-line callbacks
-            doc.add_next_tick_callback(lambda: open_conn_button.update(disabled=False))
-            doc.add_next_tick_callback(lambda: invert_sign_switch.update(disabled=False))
-            # doc.add_next_tick_callback(lambda: plot_period_input.update(disabled=False)) # Can be updated on-the-fly
+            doc.add_next_tick_callback(enable_conn_inputs)
 
             main_state = state.STOPPED
 
@@ -318,31 +468,28 @@ def main_method():
 def on_device_select(attr, old, new):
     global selected_device
 
-    selected_device = new
+    selected_device = KnownDevice[new] # Resolve the name once, on selection
 
 
 def on_open_conn_button():
-    global main_state
-
-    device_select.update(disabled=True)
-    open_conn_button.update(disabled=True)
-    invert_sign_switch.update(disabled=True)
-    # plot_period_input.update(disabled=True) # Can be updated on-the-fly
+    device_select.disabled = True
+    open_conn_button.disabled = True
+    invert_sign_switch.disabled = True
+    # plot_period_input.disabled = True # Can be updated on-the-fly
     on_clear_plot_button()
-    main_state = state.INITIALIZING
+    set_state(state.INITIALIZING)
 
 
 def on_close_conn_button():
-    global main_state
-
-    close_conn_button.update(disabled=True)
-    main_state = state.STOPPING
+    close_conn_button.disabled = True
+    set_state(state.STOPPING)
 
 
 def on_invert_sign_switch(attr, old, new):
-    global invert_current
+    global invert_current, current_sign
 
     invert_current = new
+    current_sign = -1.0 if new else 1.0
 
 
 def on_title_input(attr, old, new):
@@ -350,51 +497,91 @@ def on_title_input(attr, old, new):
 
     plot_title = new
     # fig.title.text = plot_title
-    doc.add_next_tick_callback(lambda: new_title.update(text=new))
+    new_title.text = new
 
 
 def on_log_period_input(attr, old, new):
-    global log_period_ms
+    global log_period_ms, log_period_ns
 
+    log_period_ns = int(new) * 1_000_000
     log_period_ms = new
 
 
 def on_start_log_button():
-    global csv_file, logging
+    global csv_file, csv_fh, pending_rows, logging
 
-    title_input.update(disabled=True)
-    log_period_input.update(disabled=True)
-    start_log_button.update(disabled=True)
-    stop_log_button.update(disabled=False)
-    clear_plot_button.update(disabled=True)
     csv_file = f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{plot_title.replace(' ', '-')}.csv"
+    # Keep the file open while logging instead of re-opening it for every row
+    # (opened before changing the widgets, so they stay usable if e.g. the title isn't a valid filename)
+    try:
+        csv_fh = open(csv_file, 'a', newline='', buffering=1<<16)
+    except OSError as e:
+        error_string = type(e).__name__ + ": " + str(e)
+        print(f"Failed to start logging: {error_string}")
+        status_label.text = error_string
+        return
+
+    title_input.disabled = True
+    log_period_input.disabled = True
+    start_log_button.disabled = True
+    stop_log_button.disabled = False
+    clear_plot_button.disabled = True
     on_clear_plot_button()
+    with pending_lock:
+        pending_rows = []
     logging = True
 
 
 def on_stop_log_button():
+    global csv_fh, logging
+
+    title_input.disabled = False
+    log_period_input.disabled = False
+    start_log_button.disabled = False
+    stop_log_button.disabled = True
+    clear_plot_button.disabled = False
+    logging = False
+    close_csv_file()
+
+
+def close_csv_file():
+    global csv_fh, pending_rows
+
+    with pending_lock:
+        rows = pending_rows
+        pending_rows = []
+    if csv_fh is not None:
+        csv_fh.write("".join(rows)) # Write the remaining rows before closing the file
+        # Every batch already got flushed to the OS, only force the data to the disk once, when logging stops
+        csv_fh.flush()
+        os.fsync(csv_fh.fileno())
+        csv_fh.close()
+    csv_fh = None
+
+
+def on_session_destroyed(session_context):
     global logging
 
-    title_input.update(disabled=False)
-    log_period_input.update(disabled=False)
-    start_log_button.update(disabled=False)
-    stop_log_button.update(disabled=True)
-    clear_plot_button.update(disabled=False)
+    # Write the remaining rows and close the csv-file when the browser-tab closes
     logging = False
+    close_csv_file()
 
 
 def on_plot_period_input(attr, old, new):
-    global plot_period_ms
+    global plot_period_ms, plot_period_ns
 
+    plot_period_ns = int(new) * 1_000_000
     plot_period_ms = new
 
 
 def on_clear_plot_button():
-    data_source.data = {"DateTime": [],
-                        "DateTimeStr": [],
-                        "voltage": [],
-                        "current": [],
-                        "power": []}
+    global pending, avg_reset
+
+    with pending_lock:
+        pending = empty_pending()
+    avg_reset = True # Handled by on_packet, resetting avg_count here could race with the meter-thread
+    data_source.data = empty_columns()
+    power_source.data = empty_power_columns()
 
 
 # Configure callbacks
@@ -408,6 +595,7 @@ start_log_button.on_click(on_start_log_button)
 stop_log_button.on_click(on_stop_log_button)
 plot_period_input.on_change("value", on_plot_period_input)
 clear_plot_button.on_click(on_clear_plot_button)
+doc.on_session_destroyed(on_session_destroyed)
 
 # Define the layout
 layout = column(row(device_select, open_conn_button, close_conn_button, status_label,
@@ -417,6 +605,9 @@ layout = column(row(device_select, open_conn_button, close_conn_button, status_l
                 measurement_label, Div(), fig) # Empty Divs to get more whitespace
 doc.add_root(layout)
 
+# Stream the buffered measurements to the plot and write the buffered rows to the csv-file
+doc.add_periodic_callback(flush_pending, FLUSH_PERIOD_MS)
+
 # Start the application
 thread = Thread(target=main_method, daemon=True) # daemon=True for the thead to be stopped using Ctrl+C
 thread.start()